@@ -4,7 +4,8 @@ consolidate_workspace_deps.py
 
 Consolidate duplicate dependency versions across a Cargo workspace.
 
-- Enumerates members via `cargo metadata` (supports globs, excludes, virtual roots).
+- Enumerates members via `cargo metadata` (supports globs, excludes, virtual roots)
+  and only parses manifests whose reported deps are shared with another member.
 - Finds deps that appear in ≥ 2 member crates with the SAME version requirement.
 - Moves them to root:
     [workspace.dependencies]          for normal deps
@@ -20,11 +21,20 @@ Usage:
 """
 
 from __future__ import annotations
-import argparse, json, subprocess, sys
+import argparse, os, subprocess, sys
 from pathlib import Path
 from typing import Dict, Tuple, Any, List, DefaultDict
 from collections import defaultdict
-
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tomllib
+except ModuleNotFoundError:  # Python < 3.11
+    import tomli as tomllib
+try:
+    from orjson import loads as json_loads  # much faster on big metadata output
+except ImportError:
+    from json import loads as json_loads
 import tomlkit
 from tomlkit import inline_table
 from tomlkit.items import Table, InlineTable
@@ -32,31 +42,78 @@ from tomlkit.items import Table, InlineTable
 Section = str  # "dependencies" | "dev-dependencies" | "build-dependencies"
 ROOT_WS_DEPS = "workspace.dependencies"
 ROOT_WS_DEVDEPS = "workspace.dev-dependencies"
+SECTIONS: List[Section] = ["dependencies", "dev-dependencies", "build-dependencies"]
 
 def run_metadata(root_dir: Path) -> Dict[str, Any]:
     try:
         out = subprocess.check_output(
             ["cargo", "metadata", "--format-version=1", "--no-deps"],
             cwd=root_dir,
-            text=True,
         )
     except subprocess.CalledProcessError as e:
-        print(e.output, file=sys.stderr)
+        print(e.output.decode(errors="replace"), file=sys.stderr)
         raise
-    return json.loads(out)
+    # both loaders accept bytes directly
+    return json_loads(out)
 
-def workspace_member_manifests(root_manifest: Path) -> List[Path]:
-    root_dir = root_manifest.parent
-    meta = run_metadata(root_dir)
-    id_to_manifest = {p["id"]: Path(p["manifest_path"]) for p in meta["packages"]}
-    members = [id_to_manifest[mid] for mid in meta["workspace_members"]]
+def workspace_member_packages(meta: Dict[str, Any]) -> List[Dict[str, Any]]:
+    id_to_package = {p["id"]: p for p in meta["packages"]}
+    members = [id_to_package[mid] for mid in meta["workspace_members"]]
     # Exclude non-existent (shouldn't happen) and the workspace root if it’s virtual
-    return [m for m in members if m.exists()]
+    return [m for m in members if Path(m["manifest_path"]).exists()]
+
+def manifests_with_shared_deps(packages: List[Dict[str, Any]]) -> set[Path]:
+    """
+    Manifests the TOML scan needs to see, based on dependencies already reported by `cargo metadata`:
+      - those declaring a registry dep that another member declares with the same requirement
+      - those with a normal dep named like a shared dev dep, as it blocks dev-only consolidation
+
+    It is a superset of real candidates - metadata normalizes requirements ("1.0" -> "^1.0")
+    and does not tell workspace=true from an explicit version - so the TOML scan stays authoritative.
+    """
+    seen: DefaultDict[Tuple[str, Section, str], set[Path]] = defaultdict(set)
+    for pkg in packages:
+        manifest = Path(pkg["manifest_path"])
+        for dep in pkg["dependencies"]:
+            # path deps have no source, git deps are skipped, target deps are never touched
+            source = dep["source"]
+            if source is None or source.startswith("git+") or dep.get("target"):
+                continue
+            if dep["kind"] is None:
+                section = "dependencies"
+            elif dep["kind"] == "dev":
+                section = "dev-dependencies"
+            else:
+                continue
+            name = dep.get("rename") or dep["name"]
+            seen[(name, section, dep["req"])].add(manifest)
+    shared_dev = {name for (name, section, _req), ms in seen.items() if section == "dev-dependencies" and len(ms) >= 2}
+    to_scan = set()
+    for (name, section, _req), ms in seen.items():
+        if len(ms) >= 2 or (section == "dependencies" and name in shared_dev):
+            to_scan |= ms
+    return to_scan
 
 def load_toml(path: Path) -> tomlkit.TOMLDocument:
     with path.open("r", encoding="utf-8") as f:
         return tomlkit.parse(f.read())
 
+def _scan_deps(path: Path) -> Dict[str, Any]:
+    """Fast read-only parse (plain dicts), enough to discover dependency candidates"""
+    with path.open("rb") as f:
+        return tomllib.load(f)
+
+def scan_manifest(manifest: Path) -> List[Tuple[Section, str, Any]]:
+    """All (section, dep_name, item) entries declared in the manifest"""
+    doc = _scan_deps(manifest)
+    found = []
+    for section in SECTIONS:
+        tbl = doc.get(section)
+        if not isinstance(tbl, dict):
+            continue
+        found.extend((section, name, item) for name, item in tbl.items())
+    return found
+
 def ensure_table(doc: tomlkit.TOMLDocument | Table, dotted: str) -> Table:
     parts = dotted.split(".")
     cur = doc
@@ -78,10 +135,12 @@ def is_simple_registry_dep(item: Any) -> Tuple[bool, str | None, str | None]:
     Candidate if:
       - "1.2"
       - { version = "1.2", ... } and NOT path/git and NOT workspace=true
+
+    Works both on plain dicts from the scan and on tomlkit tables.
     """
     if isinstance(item, str):
         return True, item, None
-    if isinstance(item, Table):
+    if isinstance(item, dict):
         if item.get("workspace", False):
             return False, None, "already workspace=true"
         if "path" in item or "git" in item:
@@ -95,7 +154,7 @@ def is_simple_registry_dep(item: Any) -> Tuple[bool, str | None, str | None]:
 def dep_item_to_workspace_replacement(item):
     it = tomlkit.inline_table()
     it["workspace"] = True
-    if isinstance(item, Table):
+    if isinstance(item, dict):
         for k in ("features", "optional", "default-features", "package"):
             if k in item:
                 it[k] = item[k]
@@ -148,6 +207,21 @@ def set_root_ws_dep(ws_tbl: Table, name: str, ver: str, *, force: bool):
         ws_tbl[name] = _to_inline(existing)
         return
 
+def check_rewritten(manifest: Path, text: str, edits: List[Tuple[Section, str, Any]]):
+    """
+    Re-read the rewritten manifest as the scan does and check every planned edit is there,
+    so the lossless and the fast parser cannot disagree silently.
+    """
+    doc = tomllib.loads(text)
+    missing = []
+    for section, dep_name, _item in edits:
+        tbl = doc.get(section)
+        item = tbl.get(dep_name) if isinstance(tbl, dict) else None
+        if not (isinstance(item, dict) and item.get("workspace") is True):
+            missing.append(f"{section}.{dep_name}")
+    if missing:
+        raise ValueError(f"{manifest}: planned rewrites not applied: {', '.join(missing)}")
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--root", type=Path, default=Path("Cargo.toml"), help="Path to workspace root Cargo.toml")
@@ -160,88 +234,88 @@ def main():
     if not root_manifest.exists():
         sys.exit(f"Root manifest not found: {root_manifest}")
 
-    members = workspace_member_manifests(root_manifest)
+    packages = workspace_member_packages(run_metadata(root_manifest.parent))
+    members = [Path(p["manifest_path"]) for p in packages]
     if args.verbose:
+        # scan everything, so skip reasons cover all members; filtered ones cannot change the plan
+        to_scan = set(members)
         print(f"Found {len(members)} members via cargo metadata:")
         for m in members:
             print(f"  - {m}")
+    else:
+        to_scan = manifests_with_shared_deps(packages)
 
     root_doc = load_toml(root_manifest)
     ws_deps_tbl = ensure_table(root_doc, ROOT_WS_DEPS)
     ws_dev_tbl = ensure_table(root_doc, ROOT_WS_DEVDEPS)
-
-    SECTIONS: List[Section] = ["dependencies", "dev-dependencies", "build-dependencies"]
-
-    # dep -> section -> version -> list[(manifest_path, item)]
-    occurrences: DefaultDict[str, DefaultDict[Section, DefaultDict[str, List[Tuple[Path, Any]]]]] = defaultdict(
-        lambda: defaultdict(lambda: defaultdict(list))
-    )
+    # Plain snapshot of root versions (None if not given), conflict checks need not walk tomlkit containers
+    root_versions: Dict[Section, Dict[str, Any]] = {
+        section: {k: str(v) if isinstance(v, str) else v.get("version") if isinstance(v, dict) else None
+                  for k, v in tbl.items()}
+        for section, tbl in (("dependencies", ws_deps_tbl), ("dev-dependencies", ws_dev_tbl))
+    }
+
+    # (dep, section, version) -> list[(manifest_path, item)]
+    occurrences: Dict[Tuple[str, Section, str], List[Tuple[Path, Any]]] = {}
     # For verbosity: reasons why something isn't a candidate per crate
     skip_reasons: DefaultDict[str, List[Tuple[Path, Section, str]]] = defaultdict(list)
 
-    for manifest in members:
-        doc = load_toml(manifest)
-        for section in SECTIONS:
-            tbl = doc.get(section)
-            if not isinstance(tbl, Table):
-                continue
-            for name, item in list(tbl.items()):
-                ok, ver, why = is_simple_registry_dep(item)
-                if ok:
-                    occurrences[name][section][ver].append((manifest, item))
-                else:
-                    if args.verbose and why:
-                        skip_reasons[name].append((manifest, section, why))
-
-    actions = []  # tuples describing what we'll do
+    # Manifests are independent, so read and parse them in parallel, but merge in member order
+    scanned = [m for m in members if m in to_scan]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        results = list(ex.map(scan_manifest, scanned))
+
+    for manifest, found in zip(scanned, results):
+        for section, name, item in found:
+            ok, ver, why = is_simple_registry_dep(item)
+            if ok:
+                occurrences.setdefault((name, section, ver), []).append((manifest, item))
+            else:
+                if args.verbose and why:
+                    skip_reasons[name].append((manifest, section, why))
+
+    # What we'll do: (section, dep, version) to set at root and per-manifest (section, dep, item) rewrites
+    root_sets: List[Tuple[Section, str, str]] = []
+    member_rewrites: Dict[Path, List[Tuple[Section, str, Any]]] = {}
     conflicts = []
 
     # Decide consolidations
-    for dep_name, per_section in occurrences.items():
-        # Prefer consolidating normal deps; if none, consider dev-only
-        normal = per_section.get("dependencies", {})
-        if normal:
-            for ver, items in normal.items():
-                if len(items) >= 2:
-                    # Check conflict at root
-                    existing = ws_deps_tbl.get(dep_name)
-                    if (isinstance(existing, str) and existing != ver) or (isinstance(existing, Table) and existing.get("version") != ver):
-                        if args.force:
-                            actions.append(("root_set", "dependencies", dep_name, ver))
-                        else:
-                            conflicts.append((dep_name, "dependencies", existing, ver))
-                            continue
-                    else:
-                        actions.append(("root_set", "dependencies", dep_name, ver))
-                    for manifest, item in items:
-                        actions.append(("rewrite_member", manifest, "dependencies", dep_name, item))
+    # Prefer consolidating normal deps; consider dev ones only for deps that are never normal
+    normal_deps = {name for name, section, _ver in occurrences if section == "dependencies"}
+    # Keys are in order of first (dep, section, version); group them by dep and section, as first seen,
+    # so root entries are added in order of deps' first appearance
+    first_seen: Dict[Any, int] = {}
+    for name, section, _ver in occurrences:
+        first_seen.setdefault(name, len(first_seen))
+        first_seen.setdefault((name, section), len(first_seen))
+    ordered = sorted(occurrences.items(), key=lambda kv: (first_seen[kv[0][0]], first_seen[kv[0][:2]]))
+    for (dep_name, section, ver), items in ordered:
+        if len(items) < 2:
+            continue
+        if section == "build-dependencies" or (section == "dev-dependencies" and dep_name in normal_deps):
+            continue
+        # Check conflict at root
+        root_ws = root_versions[section]
+        existing = root_ws.get(dep_name)
+        if dep_name in root_ws and existing != ver:
+            if args.force:
+                root_sets.append((section, dep_name, ver))
+            else:
+                conflicts.append((dep_name, section, existing, ver))
+                continue
         else:
-            # Dev-only consolidation
-            dev = per_section.get("dev-dependencies", {})
-            for ver, items in dev.items():
-                if len(items) >= 2:
-                    existing = ws_dev_tbl.get(dep_name)
-                    if (isinstance(existing, str) and existing != ver) or (isinstance(existing, Table) and existing.get("version") != ver):
-                        if args.force:
-                            actions.append(("root_set", "dev-dependencies", dep_name, ver))
-                        else:
-                            conflicts.append((dep_name, "dev-dependencies", existing, ver))
-                            continue
-                    else:
-                        actions.append(("root_set", "dev-dependencies", dep_name, ver))
-                    for manifest, item in items:
-                        actions.append(("rewrite_member", manifest, "dev-dependencies", dep_name, item))
+            root_sets.append((section, dep_name, ver))
+        for manifest, item in items:
+            member_rewrites.setdefault(manifest, []).append((section, dep_name, item))
 
     if args.verbose:
         # Print quick summary of candidates
         print("\nCandidates found:")
         any_cand = False
-        for dep_name, per_section in occurrences.items():
-            for sec, ver_map in per_section.items():
-                for ver, items in ver_map.items():
-                    if len(items) >= 2 and sec != "build-dependencies":
-                        print(f"  - {dep_name} {ver} ({sec}) in {len(items)} crates")
-                        any_cand = True
+        for (dep_name, sec, ver), items in ordered:
+            if len(items) >= 2 and sec != "build-dependencies":
+                print(f"  - {dep_name} {ver} ({sec}) in {len(items)} crates")
+                any_cand = True
         if not any_cand:
             print("  (none)")
 
@@ -262,56 +336,66 @@ def main():
                 print(f"  - {why}: {count}")
 
     # Nothing to do?
-    if not actions:
+    if not root_sets:
         if not conflicts:
             print("\nNo consolidations planned.")
         else:
             print("\nNo consolidations applied due to conflicts. Re-run with --force to override root versions.")
         return
 
-    # Plan -> edits
-    rewrites_by_manifest: DefaultDict[Path, List[Tuple[Section, str, Any]]] = defaultdict(list)
-    for act in actions:
-        if act[0] == "root_set":
-            continue
-        _, manifest, section, dep_name, item = act
-        rewrites_by_manifest[manifest].append((section, dep_name, item))
-
     # Dry run?
     if args.dry_run:
         print("\nPlanned changes:")
-        for act in actions:
-            if act[0] == "root_set":
-                _, section, dep, ver = act
-                dst = ROOT_WS_DEPS if section == "dependencies" else ROOT_WS_DEVDEPS
-                print(f"  - Root: set [{dst}] {dep} = \"{ver}\"")
-        for manifest, edits in rewrites_by_manifest.items():
+        for section, dep, ver in root_sets:
+            dst = ROOT_WS_DEPS if section == "dependencies" else ROOT_WS_DEVDEPS
+            print(f"  - Root: set [{dst}] {dep} = \"{ver}\"")
+        for manifest, edits in member_rewrites.items():
             print(f"  - {manifest}:")
             for section, name, _item in edits:
                 print(f"      rewrite {section}.{name} -> {{ workspace = true, ... }}")
         return
 
     # Apply root changes
-    for act in actions:
-        if act[0] != "root_set":
-            continue
-        _, section, dep_name, ver = act
+    for section, dep_name, ver in root_sets:
         if section == "dependencies":
             set_root_ws_dep(ws_deps_tbl, dep_name, ver, force=args.force)
         else:
             set_root_ws_dep(ws_dev_tbl, dep_name, ver, force=args.force)
 
 
-    # Write member manifests
-    for manifest, edits in rewrites_by_manifest.items():
+    # Rewrite member manifests - only these need lossless (tomlkit) parsing.
+    # All are done in memory first, so nothing is written if some planned edit did not apply.
+    rewritten: List[Tuple[Path, str]] = []
+    not_applied: List[Tuple[Path, Section, str]] = []
+    for manifest, edits in member_rewrites.items():
         doc = load_toml(manifest)
-        for section, dep_name, old_item in edits:
-            tbl = doc.get(section)
-            if not isinstance(tbl, Table):
+        # look up each section table once, not per edited dep
+        tables = {section: doc.get(section) for section, _name, _item in edits}
+        applied = []
+        for edit in edits:
+            section, dep_name, _item = edit
+            tbl = tables[section]
+            # besides Table it can be InlineTable (dependencies = {...}) or a proxy for [dependencies.foo] out of order
+            if not isinstance(tbl, dict) or dep_name not in tbl:
+                not_applied.append((manifest, section, dep_name))
                 continue
-            tbl[dep_name] = dep_item_to_workspace_replacement(old_item)
+            tbl[dep_name] = dep_item_to_workspace_replacement(tbl[dep_name])
+            applied.append(edit)
+        if not applied:
+            continue
+        text = tomlkit.dumps(doc)
+        check_rewritten(manifest, text, applied)
+        rewritten.append((manifest, text))
+
+    if not_applied:
+        print("\nPlanned rewrites that could not be applied:", file=sys.stderr)
+        for manifest, section, dep_name in not_applied:
+            print(f"  - {manifest}: {section}.{dep_name}", file=sys.stderr)
+        sys.exit(f"{len(not_applied)} planned rewrite(s) not applied, nothing was written")
+
+    for manifest, text in rewritten:
         with manifest.open("w", encoding="utf-8") as f:
-            f.write(tomlkit.dumps(doc))
+            f.write(text)
         print(f"Updated {manifest}")
 
     # Write root
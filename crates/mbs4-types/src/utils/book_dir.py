@@ -1,9 +1,9 @@
+import functools
 import os
 import unicodedata
 
 def initials(name):
-    names = name.split()
-    return ' '.join(map(lambda n: n[0].upper(), names))
+    return ' '.join(n[0].upper() for n in name.split())
 
 class Ebook():
     @property
@@ -30,7 +30,7 @@ class Ebook():
         return super(Ebook, self).__repr__(['title'])
 
 def ebook_base_dir(ebook):
-    return os.path.split(norm_file_name(ebook))[0]
+    return _normalize(ebook)[1]
 
 
 nd_charmap = {
@@ -60,50 +60,59 @@ nd_charmap = {
 }
 
 
+class _DiacriticsTable(dict):
+    "str.translate table for NFKD normalized text, filled lazily for unseen characters"
+    def __missing__(self, o):
+        # only non-ASCII chars not in nd_charmap get here, both are seeded below
+        v = None if unicodedata.category(chr(o)) == 'Mn' else ' '
+        self[o] = v
+        return v
+
+_diacritics_table = _DiacriticsTable((ord(k), v) for k, v in nd_charmap.items())
+_diacritics_table.update((o, chr(o)) for o in range(128))
+
+
+@functools.lru_cache(maxsize=8192)
 def remove_diacritics(text):
     "Removes diacritics from the string"
     if not text:
         return text
-    s = unicodedata.normalize('NFKD', text)
-    b = []
-    for ch in s:
-        if unicodedata.category(ch) != 'Mn':
-            if ch in nd_charmap:
-                b.append(nd_charmap[ch])
-            elif ord(ch) < 128:
-                b.append(ch)
-            else:
-                b.append(' ')
-    return ''.join(b)
+    return unicodedata.normalize('NFKD', text).translate(_diacritics_table)
 
-def norm_file_name(ebook, ext=''):
-    
-    new_name_rel = norm_file_name_base(ebook)
-    for ch in [':', '*', '%', '|', '"', '<', '>', '?', '\\']:
-        new_name_rel = new_name_rel.replace(ch, '')
-    new_name_rel += '.' + ext
+_FORBIDDEN = str.maketrans('', '', ':*%|"<>?\\')
 
-    return new_name_rel
+def _normalize(ebook):
+    """Returns normalized relative file name (without extension) and its directory,
+    callers needing both should call this once instead of norm_file_name and ebook_base_dir"""
+    name = norm_file_name_base(ebook).translate(_FORBIDDEN)
+    return name, os.path.dirname(name)
+
+def norm_file_name(ebook, ext=''):
+    return _normalize(ebook)[0] + '.' + ext
 
 def _safe_file_name(name):
     return name.replace('/', '-')
 
-BOOKS_FILE_SCHEMA = "%(author)s/%(title)s(%(language)s)/%(author)s - %(title)s"
-BOOKS_FILE_SCHEMA_SERIE = "%(author)s/%(serie)s/%(serie)s %(serie_index)d - %(title)s(%(language)s)/%(author)s - %(serie)s %(serie_index)d - %(title)s"
+# set to False to store books from series with the plain schema
+BOOKS_FILE_USE_SCHEMA_SERIE = True
+
+def _books_file_schema(author, title, language):
+    return f"{author}/{title}({language})/{author} - {title}"
+
+def _books_file_schema_serie(author, title, language, serie, serie_index):
+    return f"{author}/{serie}/{serie} {serie_index} - {title}({language})/{author} - {serie} {serie_index} - {title}"
 
 def norm_file_name_base(ebook):
-    data = {'author': _safe_file_name(ebook.authors_str),
-            'title': _safe_file_name(ebook.title),
-            'language': ebook.language.code,
-            }
-    if ebook.series:
-        data.update({'serie': _safe_file_name(ebook.series.title),
-                    'serie_index': ebook.series_index or 0})
-    if ebook.series and BOOKS_FILE_SCHEMA_SERIE:
-        new_name_rel = BOOKS_FILE_SCHEMA_SERIE % data
+    # parts are normalized separately, so repeating authors, series etc. hit the cache
+    author = remove_diacritics(_safe_file_name(ebook.authors_str))
+    title = remove_diacritics(_safe_file_name(ebook.title))
+    language = remove_diacritics(ebook.language.code)
+    if ebook.series and BOOKS_FILE_USE_SCHEMA_SERIE:
+        new_name_rel = _books_file_schema_serie(author, title, language,
+                                                remove_diacritics(_safe_file_name(ebook.series.title)),
+                                                int(ebook.series_index or 0))
         # TODO: might need to spplit base part
     else:
-        new_name_rel = BOOKS_FILE_SCHEMA % data
-    new_name_rel = remove_diacritics(new_name_rel)
+        new_name_rel = _books_file_schema(author, title, language)
     assert(len(new_name_rel) < 4096)
-    return new_name_rel
\ No newline at end of file
+    return new_name_rel